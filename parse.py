@@ -2,8 +2,13 @@
 # A voodoo interpreter of ELRC-SHARE.
 # ELRC metadata is sequentially numbered.  6000 is higher than their maximum when this was written.
 NUM_MAX=6000
+# Intermediate corpus tables are pickled here so later stages can be rerun without redoing earlier ones.
+CHECKPOINT_DIR=".checkpoints"
+import hashlib
+import inspect
 import json
 import os
+import pickle
 import re
 import sys
 import zipfile
@@ -139,6 +144,8 @@ class Corpus:
                 self.is_aligned_version_of.append(relation_with)
         self.rejected = None
         self.parse_and_reject()
+        # The raw JSON is only needed by parse_and_reject.  Drop it to save memory and keep checkpoints small.
+        del self.json_data
 
     def wget(self):
         if self.post:
@@ -639,21 +646,139 @@ def print_mtdata(corpora):
     for r in create_records(corpora):
         print(r)
 
-try:
-    corpora = load_metadata()
-except FileNotFoundError:
-    print("# Download all the JSON files first:")
-    print("for ((i=0;i<6000;++i)); do if [ ! -s $i.json ]; then echo wget -O $i.json https://www.elrc-share.eu/repository/export_json/$i/; fi; done |parallel")
-    sys.exit(1)
-hotfix_metadata(corpora)
-to_download = load_files(corpora)
-if len(to_download) != 0:
-    print("# Download the zip files:")
-    for c in to_download:
-        print(c.wget())
-    sys.exit(2)
-hotfix_files(corpora)
-print_mtdata(corpora)
+# Fingerprint input files by size and modification time.  Missing files are None.
+def file_stats(suffix):
+    stats = []
+    for i in range(NUM_MAX):
+        try:
+            st = os.stat(str(i) + suffix)
+            stats.append((st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
+# Code version of a stage: the source of everything it calls.  Stale checkpoints are silently reused for anything not listed, so every function or constant a stage (transitively) uses must be passed in stages().
+def code_version(*objects):
+    return [inspect.getsource(o) for o in objects]
+
+def hash_key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# Each stage is (name, function taking the previous stage's corpora, key).  A stage's key covers the previous key so editing an earlier stage invalidates everything after it.
+def stages():
+    # When adding a helper to a stage, add it to that stage's code_version list below.  Later stages chain the earlier keys, so e.g. Corpus.reject is covered for hotfix_metadata through metadata_key.
+    # run_stages defines the checkpoint format so it is part of the first key.
+    metadata_key = hash_key(NUM_MAX, sorted(STOPWORDS), code_version(run_stages, Tee, already_on_opus, list_if_not, possibly_empty_list, stop_word, heuristic_short_name, Corpus, load_corpus, load_metadata), file_stats(".json"))
+    hotfix_key = hash_key(metadata_key, code_version(hotfix_metadata))
+    files_key = hash_key(hotfix_key, MAP639, code_version(keep_file, normalize_language_code, sense_tmx_languages, load_files), file_stats(".zip"))
+    def run_hotfix_metadata(corpora):
+        hotfix_metadata(corpora)
+        return corpora
+    return [
+        ("metadata", lambda corpora: load_metadata(), metadata_key),
+        ("hotfix_metadata", run_hotfix_metadata, hotfix_key),
+        # Returns (corpora, to_download) so the zips still missing survive a checkpoint.
+        ("files", lambda corpora: (corpora, load_files(corpora)), files_key),
+    ]
+
+def checkpoint_path(name, key, checkpoint_dir = CHECKPOINT_DIR):
+    return os.path.join(checkpoint_dir, name + "-" + key + ".pickle")
+
+def load_checkpoint(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    # Damaged or out of date pickles can raise almost anything.  Recompute instead.
+    except Exception as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}", file=sys.stderr)
+        return None
+
+def save_checkpoint(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so an interrupted run doesn't leave a truncated checkpoint.
+    try:
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except BaseException:
+        try:
+            os.remove(path + ".tmp")
+        except FileNotFoundError:
+            pass
+        raise
+
+# Keep one checkpoint per stage: delete the ones for other keys.
+def remove_stale_checkpoints(name, keep, checkpoint_dir = CHECKPOINT_DIR):
+    for f in os.listdir(checkpoint_dir):
+        path = os.path.join(checkpoint_dir, f)
+        if f.startswith(name + "-") and f.endswith(".pickle") and path != keep:
+            os.remove(path)
+
+# Copy everything written to a stream into a list as well.
+class Tee:
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = []
+
+    def write(self, text):
+        self.written.append(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+# Run the pipeline up to and including stage until, starting from the newest valid checkpoint.  Returns that stage's output.
+# Checkpoints are (log, value) where log is the stderr of every stage so far, replayed on load so rejections can still be audited.
+def run_stages(until = "files", checkpoint_dir = CHECKPOINT_DIR):
+    pipeline = stages()
+    names = [name for name, _, _ in pipeline]
+    pipeline = pipeline[:names.index(until) + 1]
+    start = 0
+    log = ""
+    value = None
+    for i in reversed(range(len(pipeline))):
+        name, _, key = pipeline[i]
+        checkpoint = load_checkpoint(checkpoint_path(name, key, checkpoint_dir))
+        if checkpoint is not None:
+            log, value = checkpoint
+            sys.stderr.write(log)
+            print(f"Loaded {name} checkpoint", file=sys.stderr)
+            start = i + 1
+            break
+    for name, function, key in pipeline[start:]:
+        tee = Tee(sys.stderr)
+        sys.stderr = tee
+        try:
+            value = function(value)
+        finally:
+            sys.stderr = tee.stream
+        log += ''.join(tee.written)
+        path = checkpoint_path(name, key, checkpoint_dir)
+        save_checkpoint(path, (log, value))
+        remove_stale_checkpoints(name, path, checkpoint_dir)
+    return value
+
+def main():
+    try:
+        corpora, to_download = run_stages("files")
+    except FileNotFoundError:
+        print("# Download all the JSON files first:")
+        print("for ((i=0;i<6000;++i)); do if [ ! -s $i.json ]; then echo wget -O $i.json https://www.elrc-share.eu/repository/export_json/$i/; fi; done |parallel")
+        sys.exit(1)
+    if len(to_download) != 0:
+        print("# Download the zip files:")
+        for c in to_download:
+            print(c.wget())
+        sys.exit(2)
+    hotfix_files(corpora)
+    print_mtdata(corpora)
+
+if __name__ == "__main__":
+    # Run through the parse module so checkpoints pickle parse.Corpus, not __main__.Corpus, and are shared with import parse.
+    import parse
+    parse.main()
 
 # TSV of failures
 #with open("../fails.txt") as f: